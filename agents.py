@@ -5,15 +5,191 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.cloud import aiplatform
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from cachetools import TTLCache
+import google_auth_httplib2
+import httplib2
+import asyncio
+import threading
+import random
+import time
 import os
+import tempfile
+import json
 import pickle
+import sqlite3
 import base64
-from email.mime.text import MIMEText
+from email.header import Header
+from email.utils import formataddr, getaddresses
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Gmail rejects batch requests with more than 100 calls
+BATCH_SIZE = 100
+
+# Gmail allows 250 quota units/sec per user and messages.get costs 5 units,
+# so cap the number of batch requests in flight at once
+_BATCH_SEMAPHORE = threading.BoundedSemaphore(10)
+
+# Serializes token refreshes so concurrent requests don't each hit the token endpoint
+_REFRESH_LOCK = threading.Lock()
+
+# Only the parts of a message that _parse_message reads
+MESSAGE_FIELDS = 'id,snippet,payload/headers'
+
+# Agents tend to repeat the same queries within a workflow, so recent
+# results are served from memory for a short while
+READ_CACHE_TTL = 30
+READ_CACHE_SIZE = 256
+
+# Last synced Gmail historyId per account, for incremental reads
+HISTORY_DB = 'history.sqlite3'
+
+TOKEN_FILE = 'token.json'
+# Written by earlier versions; migrated to TOKEN_FILE on first load
+LEGACY_TOKEN_FILE = 'token.pickle'
+PICKLE_MAGIC = b'\x80'
+
+MAX_RETRIES = 5
+RETRYABLE_STATUSES = {429, 500, 503}
+# Sending isn't idempotent: a 5xx may arrive after Gmail accepted the message,
+# so only rate-limit rejections are safe to resend
+SEND_RETRYABLE_STATUSES = {429}
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff with jitter, capped at 32 seconds"""
+    return min(2 ** attempt + random.random(), 32)
+
+def _is_retryable(error: Exception, statuses=RETRYABLE_STATUSES) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in statuses
+
+def execute_with_retry(fn, retries: int = MAX_RETRIES, statuses=RETRYABLE_STATUSES):
+    """Call fn, backing off on Gmail rate-limit and transient server errors"""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except HttpError as e:
+            if not _is_retryable(e, statuses) or attempt == retries:
+                raise
+            time.sleep(_backoff(attempt))
+
+def _extract_headers(payload: Dict, wanted=('Subject', 'From')) -> Dict[str, str]:
+    """Map the wanted header names to their values in a single pass"""
+    return {h['name']: h['value'] for h in payload.get('headers', ()) if h['name'] in wanted}
+
+# Wire format for plain-text messages, filled in directly instead of going
+# through email.generator
+_MESSAGE_TEMPLATE = (
+    "To: {to}\r\n"
+    "Subject: {subject}\r\n"
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: text/plain; charset=\"utf-8\"\r\n"
+    "Content-Transfer-Encoding: {encoding}\r\n"
+    "\r\n"
+)
+
+def _check_header(value: str) -> str:
+    if '\r' in value or '\n' in value:
+        raise ValueError("Email headers must not contain line breaks")
+    return value
+
+def _encode_subject(subject: str) -> str:
+    """RFC 2047-encode the subject only when it isn't plain ASCII"""
+    _check_header(subject)
+    return subject if subject.isascii() else Header(subject, 'utf-8').encode(linesep='\r\n')
+
+def _encode_address(address: str) -> str:
+    """IDNA-encode an internationalized domain; non-ASCII local parts can't be sent"""
+    local, at, domain = address.rpartition('@')
+    if not at or not local or not domain:
+        raise ValueError(f"Not a valid email address: {address!r}")
+    if address.isascii():
+        return address
+    if not local.isascii():
+        raise ValueError(f"Email address has a non-ASCII local part: {address}")
+    try:
+        return f"{local}@{domain.encode('idna').decode('ascii')}"
+    except UnicodeError:
+        raise ValueError(f"Email address has an invalid domain: {address}") from None
+
+def _encode_recipients(to: str) -> str:
+    """Encode non-ASCII display names and domains in the recipient list"""
+    _check_header(to)
+    if to.isascii():
+        return to
+    return ', '.join(
+        formataddr((name, _encode_address(address)), charset='utf-8')
+        for name, address in getaddresses([to])
+    )
+
+def _build_raw_message(to: str, subject: str, body: str) -> str:
+    """Build the base64url-encoded RFC 5322 message Gmail expects"""
+    if body.isascii():
+        encoding, payload = '7bit', body.encode('ascii')
+    else:
+        encoding, payload = 'base64', base64.encodebytes(body.encode('utf-8'))
+    headers = _MESSAGE_TEMPLATE.format(
+        to=_encode_recipients(to),
+        subject=_encode_subject(subject),
+        encoding=encoding
+    )
+    return base64.urlsafe_b64encode(headers.encode('ascii') + payload).decode('ascii')
+
+def _is_not_found(error: Exception) -> bool:
+    return isinstance(error, HttpError) and error.resp.status == 404
+
+async def _acquire_thread_lock(lock: threading.Lock) -> None:
+    """Acquire a threading lock without blocking the event loop"""
+    if lock.acquire(blocking=False):
+        return
+    acquiring = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # The worker thread may still take the lock; hand it straight back
+        acquiring.add_done_callback(
+            lambda f: lock.release() if not f.cancelled() and f.exception() is None else None
+        )
+        raise
+
+def _run_sync(coro):
+    """Run a coroutine to completion from synchronous code"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # Called from inside an event loop: finish the coroutine on a fresh thread
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+class HistoryStore:
+    """Persist the last synced Gmail historyId per account in SQLite"""
+
+    def __init__(self, path: str = HISTORY_DB):
+        self.path = path
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS history (account TEXT PRIMARY KEY, history_id TEXT NOT NULL)"
+            )
+
+    def get(self, account: str):
+        with closing(sqlite3.connect(self.path)) as conn:
+            row = conn.execute(
+                "SELECT history_id FROM history WHERE account = ?", (account,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, account: str, history_id: str) -> None:
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO history (account, history_id) VALUES (?, ?)",
+                (account, history_id)
+            )
+
 class GmailTools:
     def __init__(self):
         self.SCOPES = [
@@ -23,17 +199,22 @@ class GmailTools:
         ]
         self.creds = None
         self.service = None
+        self._read_cache = TTLCache(maxsize=READ_CACHE_SIZE, ttl=READ_CACHE_TTL)
+        self._read_cache_lock = threading.Lock()
+        self._history = HistoryStore()
+        self._account = None
+        # Held across the whole historyId read/list/fetch/store sequence
+        self._sync_lock = threading.Lock()
+        self._local = threading.local()
         self.authenticate()
 
     def authenticate(self):
         """Handle Gmail authentication"""
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                self.creds = pickle.load(token)
+        self.creds = self._load_credentials()
                 
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
+                self._refresh_credentials()
             else:
                 flow = InstalledAppFlow.from_client_config({
                     "installed": {
@@ -45,68 +226,309 @@ class GmailTools:
                     }
                 }, self.SCOPES)
                 self.creds = flow.run_local_server(port=0)
+                self._save_credentials()
                 
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(self.creds, token)
-                
-        self.service = build('gmail', 'v1', credentials=self.creds)
+        # Use the discovery document bundled with the client library instead
+        # of fetching it over the network on every start
+        self.service = build(
+            'gmail', 'v1',
+            credentials=self.creds,
+            static_discovery=True,
+            cache_discovery=False
+        )
+        # Each users()/messages() call builds a new Resource, so build them once
+        self._users = self.service.users()
+        self._messages = self._users.messages()
+        self._history_api = self._users.history()
+        self._new_batch = self.service.new_batch_http_request
+
+    def _load_credentials(self):
+        """Load saved credentials, upgrading a legacy pickle token to JSON"""
+        if os.path.exists(TOKEN_FILE):
+            with open(TOKEN_FILE) as token:
+                return Credentials.from_authorized_user_info(json.load(token), self.SCOPES)
+
+        if os.path.exists(LEGACY_TOKEN_FILE):
+            with open(LEGACY_TOKEN_FILE, 'rb') as token:
+                data = token.read()
+            if data.startswith(PICKLE_MAGIC):
+                self.creds = pickle.loads(data)
+                self._save_credentials()
+                os.remove(LEGACY_TOKEN_FILE)
+                return self.creds
+
+        return None
+
+    def _save_credentials(self):
+        """Atomically replace the token file so other workers never read a partial write"""
+        directory = os.path.dirname(os.path.abspath(TOKEN_FILE))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.token-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as token:
+                token.write(self.creds.to_json())
+            os.replace(tmp_path, TOKEN_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _refresh_credentials(self):
+        """Refresh expired credentials and persist them so other workers skip the refresh"""
+        with _REFRESH_LOCK:
+            if self.creds.valid:
+                return
+            self.creds.refresh(Request())
+            self._save_credentials()
+
+    async def ensure_credentials(self):
+        """Refresh credentials on a worker thread instead of blocking the event loop"""
+        if not self.creds.valid:
+            await asyncio.to_thread(self._refresh_credentials)
+
+    def _http(self):
+        """Return this thread's authorized transport
+
+        httplib2 is not thread-safe, so each thread gets its own, created on
+        first use and kept so its keep-alive connections are reused.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            self._local.http = http
+        return http
 
     def read_emails(self, max_results: int = 10, query: str = None) -> List[Dict]:
         """Read emails from Gmail"""
-        results = self.service.users().messages().list(
+        return _run_sync(self.aread_emails(max_results, query))
+
+    async def aread_emails(self, max_results: int = 10, query: str = None) -> List[Dict]:
+        """Read emails from Gmail, fetching batch chunks concurrently"""
+        key = (query, max_results)
+        with self._read_cache_lock:
+            cached = self._read_cache.get(key)
+        if cached is not None:
+            return list(cached)
+
+        await self.ensure_credentials()
+        request = self._messages.list(
             userId='me', 
             maxResults=max_results,
             q=query
-        ).execute()
+        )
+        results = await asyncio.to_thread(
+            execute_with_retry, lambda: request.execute(http=self._http())
+        )
         
         messages = results.get('messages', [])
-        emails = []
-        
-        for message in messages:
-            msg = self.service.users().messages().get(
-                userId='me', 
-                id=message['id']
-            ).execute()
-            
-            headers = msg['payload']['headers']
-            subject = next(h['value'] for h in headers if h['name'] == 'Subject')
-            sender = next(h['value'] for h in headers if h['name'] == 'From')
-            
-            emails.append({
-                'id': message['id'],
-                'subject': subject,
-                'sender': sender,
-                'snippet': msg['snippet']
-            })
-            
+        emails = await self._fetch_messages([message['id'] for message in messages])
+        with self._read_cache_lock:
+            self._read_cache[key] = emails
+        return list(emails)
+
+    def read_new_emails(self, max_results: int = 10) -> List[Dict]:
+        """Read inbox emails that arrived since the previous call"""
+        return _run_sync(self.aread_new_emails(max_results))
+
+    async def aread_new_emails(self, max_results: int = 10) -> List[Dict]:
+        """Read inbox emails that arrived since the previous call
+
+        Only the changes since the stored historyId are listed. The first call,
+        or one whose historyId Gmail has expired, falls back to listing the
+        latest max_results messages.
+        """
+        await self.ensure_credentials()
+        if self._account is None:
+            profile = await asyncio.to_thread(
+                execute_with_retry,
+                lambda: self._users.getProfile(userId='me').execute(http=self._http())
+            )
+            self._account = profile['emailAddress']
+
+        # A threading lock, since callers run on different threads and event
+        # loops; overlapping syncs would return the same messages twice and
+        # could move the stored cursor backwards
+        await _acquire_thread_lock(self._sync_lock)
+        try:
+            last_history_id = await asyncio.to_thread(self._history.get, self._account)
+            message_ids = None
+            if last_history_id is not None:
+                try:
+                    message_ids, history_id = await asyncio.to_thread(self._list_history, last_history_id)
+                except HttpError as e:
+                    if not _is_not_found(e):
+                        raise
+
+            if message_ids is None:
+                message_ids, history_id = await asyncio.to_thread(self._list_inbox, max_results)
+
+            emails = await self._fetch_messages(message_ids)
+            await asyncio.to_thread(self._history.set, self._account, history_id)
+        finally:
+            self._sync_lock.release()
+        return emails
+
+    def _list_inbox(self, max_results: int):
+        """List the newest inbox message IDs along with the mailbox's current historyId"""
+        http = self._http()
+        # Read the historyId first so nothing arriving during the listing is skipped
+        profile = execute_with_retry(
+            lambda: self._users.getProfile(userId='me').execute(http=http)
+        )
+        results = execute_with_retry(
+            lambda: self._messages.list(
+                userId='me',
+                maxResults=max_results,
+                labelIds=['INBOX']
+            ).execute(http=http)
+        )
+        message_ids = [message['id'] for message in results.get('messages', [])]
+        return message_ids, profile['historyId']
+
+    def _list_history(self, start_history_id: str):
+        """List IDs of inbox messages added since start_history_id, newest first"""
+        http = self._http()
+        message_ids = []
+        history_id = start_history_id
+        page_token = None
+        while True:
+            response = execute_with_retry(
+                lambda: self._history_api.list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes='messageAdded',
+                    labelId='INBOX',
+                    pageToken=page_token
+                ).execute(http=http)
+            )
+            for record in response.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message_ids.append(added['message']['id'])
+            history_id = response.get('historyId', history_id)
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+        # History is returned oldest first; match messages.list ordering
+        return list(dict.fromkeys(reversed(message_ids))), history_id
+
+    async def _fetch_messages(self, message_ids: List[str]) -> List[Dict]:
+        """Fetch messages in concurrent batch chunks, skipping any deleted meanwhile"""
+        chunks = [
+            message_ids[offset:offset + BATCH_SIZE]
+            for offset in range(0, len(message_ids), BATCH_SIZE)
+        ]
+        fetched = await asyncio.gather(
+            *[asyncio.to_thread(self._fetch_batch, chunk) for chunk in chunks]
+        )
+        return [email for chunk in fetched for email in chunk if email is not None]
+
+    def clear_read_cache(self):
+        """Drop cached reads, e.g. after sending changes what queries return"""
+        with self._read_cache_lock:
+            self._read_cache.clear()
+
+    def _fetch_batch(self, message_ids: List[str]) -> List[Dict]:
+        """Fetch up to BATCH_SIZE messages in one HTTP round trip, retrying throttled calls"""
+        emails = [None] * len(message_ids)
+        pending = list(range(len(message_ids)))
+
+        for attempt in range(MAX_RETRIES + 1):
+            throttled = []
+
+            def callback(request_id, response, exception):
+                index = int(request_id)
+                if exception is None:
+                    emails[index] = self._parse_message(response)
+                elif _is_not_found(exception):
+                    # Deleted between listing and fetching; leave the slot empty
+                    pass
+                elif _is_retryable(exception) and attempt < MAX_RETRIES:
+                    throttled.append(index)
+                else:
+                    raise exception
+
+            batch = self._new_batch(callback=callback)
+            for index in pending:
+                batch.add(
+                    self._messages.get(
+                        userId='me',
+                        id=message_ids[index],
+                        format='metadata',
+                        metadataHeaders=['Subject', 'From'],
+                        fields=MESSAGE_FIELDS
+                    ),
+                    request_id=str(index)
+                )
+
+            try:
+                with _BATCH_SEMAPHORE:
+                    batch.execute(http=self._http())
+            except HttpError as e:
+                if not _is_retryable(e) or attempt == MAX_RETRIES:
+                    raise
+                # The whole batch was rejected, so resend every pending call
+                throttled = pending
+
+            if not throttled:
+                break
+            pending = sorted(throttled)
+            time.sleep(_backoff(attempt))
+
         return emails
 
+    @staticmethod
+    def _parse_message(msg: Dict) -> Dict:
+        """Reduce a Gmail message resource to the fields the agents use"""
+        headers = _extract_headers(msg['payload'])
+
+        return {
+            'id': msg['id'],
+            'subject': headers.get('Subject', ''),
+            'sender': headers.get('From', ''),
+            'snippet': msg['snippet']
+        }
+
     def send_email(self, to: str, subject: str, body: str) -> Dict:
         """Send an email"""
-        message = MIMEText(body)
-        message['to'] = to
-        message['subject'] = subject
-        
-        raw = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+        if not self.creds.valid:
+            self._refresh_credentials()
+
+        raw = _build_raw_message(to, subject, body)
         
-        sent_message = self.service.users().messages().send(
+        request = self._messages.send(
             userId='me',
             body={'raw': raw}
-        ).execute()
+        )
+        sent_message = execute_with_retry(
+            lambda: request.execute(http=self._http()),
+            statuses=SEND_RETRYABLE_STATUSES
+        )
+        # The sent message now shows up in queries such as in:sent
+        self.clear_read_cache()
         
         return {'message_id': sent_message['id']}
 
 class EmailTools:
     def __init__(self):
         self.gmail_tools = GmailTools()
+        self._tools = self._build_tools()
         
     def get_tools(self):
+        """Return the tool list shared by every agent"""
+        return self._tools
+
+    def _build_tools(self):
         return [
             Tool(
                 name="ReadEmails",
                 func=self.gmail_tools.read_emails,
+                coroutine=self.gmail_tools.aread_emails,
                 description="Read emails from Gmail. Parameters: max_results (int, optional), query (str, optional)"
             ),
+            Tool(
+                name="ReadNewEmails",
+                func=self.gmail_tools.read_new_emails,
+                coroutine=self.gmail_tools.aread_new_emails,
+                description="Read inbox emails that arrived since the last check. Parameters: max_results (int, optional, used on the first check)"
+            ),
             Tool(
                 name="SendEmail",
                 func=self.gmail_tools.send_email,
@@ -115,8 +537,9 @@ class EmailTools:
         ]
 
 def create_jared_crew():
-    # Initialize tools
+    # Initialize tools once; every agent gets the same list
     email_tools = EmailTools()
+    tools = email_tools.get_tools()
     
     # Email Reader Agent
     email_reader = Agent(
@@ -124,7 +547,7 @@ def create_jared_crew():
         goal='Efficiently read and understand email content',
         backstory="""You are an expert at reading and comprehending emails. 
         Your responsibility is to process email content and extract key information.""",
-        tools=email_tools.get_tools(),
+        tools=tools,
         verbose=True
     )
     
@@ -134,7 +557,7 @@ def create_jared_crew():
         goal='Analyze emails and provide insights',
         backstory="""You are an expert at analyzing email content and identifying patterns, 
         priorities, and action items. You work with the Email Reader to process information.""",
-        tools=email_tools.get_tools(),
+        tools=tools,
         verbose=True
     )
     
@@ -144,12 +567,13 @@ def create_jared_crew():
         goal='Compose and send effective emails',
         backstory="""You are an expert at writing clear and effective emails. 
         You can draft responses and new emails based on analysis and requirements.""",
-        tools=email_tools.get_tools(),
+        tools=tools,
         verbose=True
     )
     
     return {
         'reader': email_reader,
         'analyzer': email_analyzer,
-        'composer': email_composer
+        'composer': email_composer,
+        'gmail': email_tools.gmail_tools
     }
@@ -1,10 +1,17 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import RedirectResponse
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks
+from fastapi.responses import RedirectResponse, ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from typing import Optional, List, Dict, Any
 from crewai import Crew, Task
 from agents import create_jared_crew
 from security import SecureEmailHandler, EmailWorkflowOrchestrator, EmailAgentTelemetry
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from functools import lru_cache
+from uuid import uuid4
+import asyncio
+import anyio
+import json
 import uvicorn
 import os
 from google_auth_oauthlib.flow import Flow
@@ -12,50 +19,134 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI(title="Jared Email Assistant API")
-jared_crew = create_jared_crew()
-secure_handler = SecureEmailHandler()
-telemetry = EmailAgentTelemetry()
+app = FastAPI(title="Jared Email Assistant API", default_response_class=ORJSONResponse)
 
-# Initialize workflow orchestrator (we'll add vector store integration later)
-workflow = EmailWorkflowOrchestrator(jared_crew, None)
+# Built in the startup hook so only processes that serve requests pay for
+# Gmail authentication and agent construction
+jared_crew: Optional[Dict[str, Any]] = None
+secure_handler: Optional[SecureEmailHandler] = None
+telemetry: Optional[EmailAgentTelemetry] = None
+workflow: Optional[EmailWorkflowOrchestrator] = None
 
 # OAuth2 Configuration
 CLIENT_SECRETS_FILE = "client_secrets.json"
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly',
           'https://www.googleapis.com/auth/gmail.send']
 
+@lru_cache(maxsize=None)
+def client_config() -> Dict[str, Any]:
+    """Read and parse the OAuth client secrets once per process"""
+    with open(CLIENT_SECRETS_FILE) as f:
+        return json.load(f)
+
+# Crew runs make several LLM calls each, so they are queued as background jobs
+# with their own concurrency limit instead of holding the HTTP request open
+CREW_CONCURRENCY = int(os.getenv("CREW_CONCURRENCY", "4"))
+# Finished jobs kept for polling, and queued or running jobs accepted at once
+MAX_JOBS = 1000
+MAX_ACTIVE_JOBS = int(os.getenv("MAX_ACTIVE_JOBS", "100"))
+crew_slots = asyncio.Semaphore(CREW_CONCURRENCY)
+jobs: Dict[str, Dict[str, Any]] = {}
+# Finished job ids, oldest first; only these are ever evicted
+finished_jobs: deque = deque()
+active_jobs = 0
+
+@app.on_event("startup")
+async def create_services():
+    """Build the crew, Gmail client and helpers for this worker process"""
+    global jared_crew, secure_handler, telemetry, workflow
+    jared_crew = create_jared_crew()
+    secure_handler = SecureEmailHandler()
+    telemetry = EmailAgentTelemetry()
+
+    # Initialize workflow orchestrator (we'll add vector store integration later)
+    workflow = EmailWorkflowOrchestrator(jared_crew, None)
+
+@app.on_event("startup")
+async def configure_thread_pools():
+    """Size the thread pools that run blocking work for this worker process"""
+    # asyncio.to_thread: CrewAI kickoffs, Gmail and OAuth calls
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=16))
+    # anyio: sync endpoints and dependencies run by Starlette
+    anyio.to_thread.current_default_thread_limiter().total_tokens = 32
+
 class EmailRequest(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid', str_strip_whitespace=True)
+
     to: str
     subject: str
     body: str
 
 class EmailQuery(BaseModel):
+    model_config = ConfigDict(frozen=True, extra='forbid', str_strip_whitespace=True)
+
     max_results: Optional[int] = 10
     query: Optional[str] = None
 
-@app.post("/read-emails")
-async def read_emails(query: EmailQuery):
-    """Read and analyze emails"""
-    try:
-        telemetry.log_email_interaction("read_emails", {"query": query.dict()})
-        
-        # Create crew and tasks
-        crew = Crew(
-            agents=[jared_crew['reader'], jared_crew['analyzer']],
-            tasks=[
-                Task(
-                    description=f"Read {query.max_results} emails with query: {query.query}",
-                    agent=jared_crew['reader']
-                ),
-                Task(
-                    description="Analyze the emails and provide insights",
-                    agent=jared_crew['analyzer']
-                )
-            ]
+# Task prompts; each request fills in only the fields that vary
+READ_TASK = "Analyze these emails and provide insights:\n\n{emails}"
+SEND_TASK = "Send email to {to} with subject: {subject}"
+ANALYZE_TASK = "Analyze this conversation matching query: {query}\n\n{emails}"
+
+async def run_task(agent_name: str, description: str):
+    """Run a single-task crew for one of the prebuilt agents on a worker thread"""
+    agent = jared_crew[agent_name]
+    crew = Crew(agents=[agent], tasks=[Task(description=description, agent=agent)])
+    return await asyncio.to_thread(crew.kickoff)
+
+def format_emails(emails: List[Dict[str, Any]]) -> str:
+    """Render fetched emails as prompt text for the analyzer"""
+    return "\n\n".join(
+        f"From: {e['sender']}\nSubject: {e['subject']}\n{e['snippet']}" for e in emails
+    )
+
+def submit_job(background_tasks: BackgroundTasks, work, error_message: str) -> Dict[str, str]:
+    """Queue work to run after the response is sent and return its job id"""
+    global active_jobs
+    if active_jobs >= MAX_ACTIVE_JOBS:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many jobs in progress, try again later",
+            headers={"Retry-After": "30"}
         )
-        
-        result = crew.kickoff()
+    active_jobs += 1
+    job_id = uuid4().hex
+    jobs[job_id] = {"status": "pending", "result": None, "error": None}
+    background_tasks.add_task(run_job, job_id, work, error_message)
+    return {"job_id": job_id}
+
+async def run_job(job_id: str, work, error_message: str) -> None:
+    """Run a queued job once a crew slot is free and record its outcome"""
+    global active_jobs
+    try:
+        async with crew_slots:
+            jobs[job_id]["status"] = "running"
+            try:
+                result = await work()
+            except Exception as e:
+                telemetry.log_error(error_message, str(e))
+                outcome = {"status": "failed", "error": str(e)}
+            else:
+                outcome = {"status": "completed", "result": result}
+        jobs[job_id].update(outcome)
+    finally:
+        active_jobs -= 1
+
+    # Forget the oldest finished jobs so results that are never polled don't pile up
+    finished_jobs.append(job_id)
+    while len(finished_jobs) > MAX_JOBS:
+        jobs.pop(finished_jobs.popleft(), None)
+
+@app.post("/read-emails", status_code=202)
+async def read_emails(query: EmailQuery, background_tasks: BackgroundTasks):
+    """Read and analyze emails"""
+    telemetry.log_email_interaction("read_emails", {"query": query.model_dump()})
+
+    async def work():
+        # Fetch directly from Gmail so only the analysis needs an LLM round trip
+        emails = await jared_crew['gmail'].aread_emails(query.max_results, query.query)
+
+        result = await run_task('analyzer', READ_TASK.format(emails=format_emails(emails)))
         
         # Encrypt sensitive data before returning
         if result.get("sensitive_content"):
@@ -64,16 +155,15 @@ async def read_emails(query: EmailQuery):
             )
         
         return {"result": result}
-    except Exception as e:
-        telemetry.log_error("Failed to read emails", str(e))
-        raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/send-email")
-async def send_email(email: EmailRequest):
+    return submit_job(background_tasks, work, "Failed to read emails")
+
+@app.post("/send-email", status_code=202)
+async def send_email(email: EmailRequest, background_tasks: BackgroundTasks):
     """Compose and send an email"""
-    try:
-        telemetry.log_email_interaction("send_email", {"to": email.to, "subject": email.subject})
-        
+    telemetry.log_email_interaction("send_email", {"to": email.to, "subject": email.subject})
+
+    async def work():
         # Process email through workflow
         workflow_result = await workflow.process_incoming_email({
             "to": email.to,
@@ -81,63 +171,59 @@ async def send_email(email: EmailRequest):
             "content": email.body
         })
         
-        # Create crew and tasks
-        crew = Crew(
-            agents=[jared_crew['composer']],
-            tasks=[
-                Task(
-                    description=f"Send email to {email.to} with subject: {email.subject}",
-                    agent=jared_crew['composer']
-                )
-            ]
-        )
-        
-        result = crew.kickoff()
+        result = await run_task('composer', SEND_TASK.format(to=email.to, subject=email.subject))
         return {
             "result": result,
             "workflow": workflow_result
         }
-    except Exception as e:
-        telemetry.log_error("Failed to send email", str(e))
-        raise HTTPException(status_code=500, detail=str(e))
 
-@app.post("/analyze-conversation")
-async def analyze_conversation(query: EmailQuery):
+    return submit_job(background_tasks, work, "Failed to send email")
+
+@app.post("/analyze-conversation", status_code=202)
+async def analyze_conversation(query: EmailQuery, background_tasks: BackgroundTasks):
     """Analyze email conversations"""
-    try:
-        telemetry.log_email_interaction("analyze_conversation", {"query": query.dict()})
-        
-        # Create crew and tasks
-        crew = Crew(
-            agents=[jared_crew['analyzer']],
-            tasks=[
-                Task(
-                    description=f"Analyze conversation with query: {query.query}",
-                    agent=jared_crew['analyzer']
-                )
-            ]
+    telemetry.log_email_interaction("analyze_conversation", {"query": query.model_dump()})
+
+    async def work():
+        # Both sides of the conversation are independent reads, so fetch them
+        # together and hand the merged thread to a single analyzer call
+        gmail = jared_crew['gmail']
+        sent_query = " ".join(filter(None, ["in:sent", query.query]))
+        received, sent = await asyncio.gather(
+            gmail.aread_emails(query.max_results, query.query),
+            gmail.aread_emails(query.max_results, sent_query)
+        )
+        conversation = list({e['id']: e for e in received + sent}.values())
+
+        result = await run_task(
+            'analyzer', ANALYZE_TASK.format(query=query.query, emails=format_emails(conversation))
         )
-        
-        result = crew.kickoff()
         return {"result": result}
-    except Exception as e:
-        telemetry.log_error("Failed to analyze conversation", str(e))
-        raise HTTPException(status_code=500, detail=str(e))
+
+    return submit_job(background_tasks, work, "Failed to analyze conversation")
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Poll the status and result of a queued job"""
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {"job_id": job_id, **job}
 
 @app.get("/auth/callback")
 async def auth_callback(request: Request):
     """Handle the OAuth2 callback from Google"""
     try:
         # Create flow instance to manage the OAuth 2.0 Authorization Grant Flow
-        flow = Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE,
+        flow = Flow.from_client_config(
+            client_config(),
             scopes=SCOPES,
             redirect_uri=f"http://{request.base_url.hostname}:{request.base_url.port}/auth/callback"
         )
         
         # Use the authorization server's response to fetch the OAuth 2.0 tokens
         authorization_response = str(request.url)
-        flow.fetch_token(authorization_response=authorization_response)
+        await asyncio.to_thread(flow.fetch_token, authorization_response=authorization_response)
         
         # Store the credentials
         credentials = flow.credentials
@@ -152,8 +238,8 @@ async def auth_callback(request: Request):
 async def login():
     """Initiate the OAuth2 login flow"""
     try:
-        flow = Flow.from_client_secrets_file(
-            CLIENT_SECRETS_FILE,
+        flow = Flow.from_client_config(
+            client_config(),
             scopes=SCOPES,
             redirect_uri="http://localhost:8000/auth/callback"
         )
@@ -170,4 +256,8 @@ async def login():
         raise HTTPException(status_code=400, detail=str(e))
 
 if __name__ == "__main__":
+    # Job state lives in this process's memory, and workers sharing a socket
+    # can't be pinned per client, so /jobs polls would miss on other workers
+    if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        raise SystemExit("Multiple workers are not supported while jobs are kept in memory")
     uvicorn.run(app, host="0.0.0.0", port=8000)
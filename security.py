@@ -1,27 +1,84 @@
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import logging
+import logging.handlers
+import atexit
+import queue
 from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.trace import Status, StatusCode
 from datetime import datetime
-import json
-from typing import Optional, Dict, Any
+import orjson
+import asyncio
+import base64
+import os
+from typing import Optional, Dict, Any, Iterator, Union
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def _load_encryption_key() -> bytes:
+    """Read the Fernet key from the environment, falling back to a per-process key"""
+    key = os.getenv('EMAIL_FERNET_KEY')
+    if key:
+        return key.encode()
+    logging.getLogger(__name__).warning(
+        "EMAIL_FERNET_KEY is not set; data encrypted by this process can't be decrypted after a restart"
+    )
+    return Fernet.generate_key()
+
+def _derive_aead_key(key: bytes) -> bytes:
+    """Derive a dedicated AES-256-GCM key so the Fernet key material isn't reused directly"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'email-agent aes-gcm'
+    ).derive(base64.urlsafe_b64decode(key))
+
+# Built once per process and shared by every handler
+_ENCRYPTION_KEY = _load_encryption_key()
+_CIPHER = Fernet(_ENCRYPTION_KEY)
+_AEAD = AESGCM(_derive_aead_key(_ENCRYPTION_KEY))
+
+# Leading byte of each ciphertext format. Fernet tokens decode to a leading 0x80,
+# so tokens written before the switch to AES-GCM can still be told apart
+_AEAD_VERSION = b'\x01'
+_STREAM_VERSION = b'\x02'
+NONCE_SIZE = 12
+_TAG_SIZE = 16
+_NONCE_PREFIX_SIZE = 8
+_STREAM_HEADER_SIZE = 1 + _NONCE_PREFIX_SIZE + 4
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def _chunk_aad(last: bool) -> bytes:
+    """Bind the final-chunk flag into each chunk so truncated streams fail to decrypt"""
+    return b'\x01' if last else b'\x00'
 
 class SecureEmailHandler:
     def __init__(self):
-        """Initialize encryption handler with a new key"""
-        self.encryption_key = Fernet.generate_key()
-        self.cipher_suite = Fernet(self.encryption_key)
+        """Initialize encryption handler with the shared process-wide key"""
+        self.encryption_key = _ENCRYPTION_KEY
+        self.cipher_suite = _CIPHER
+        self._aead = _AEAD
     
-    def encrypt_sensitive_data(self, data: str) -> bytes:
+    def encrypt_sensitive_data(self, data: Union[str, bytes]) -> bytes:
         """Encrypt sensitive email content
         
         Args:
-            data: String data to encrypt
+            data: String or already-encoded bytes to encrypt
             
         Returns:
-            Encrypted bytes
+            URL-safe base64 token of the version byte, nonce and AES-GCM ciphertext
         """
-        return self.cipher_suite.encrypt(data.encode())
+        nonce = os.urandom(NONCE_SIZE)
+        plaintext = data.encode() if isinstance(data, str) else data
+        ciphertext = self._aead.encrypt(nonce, plaintext, None)
+        return base64.urlsafe_b64encode(_AEAD_VERSION + nonce + ciphertext)
     
     def decrypt_sensitive_data(self, encrypted_data: bytes) -> str:
         """Decrypt sensitive email content
@@ -32,7 +89,55 @@ class SecureEmailHandler:
         Returns:
             Decrypted string
         """
-        return self.cipher_suite.decrypt(encrypted_data).decode()
+        token = base64.urlsafe_b64decode(encrypted_data)
+        if token[:1] != _AEAD_VERSION:
+            # Written by the Fernet implementation
+            return self.cipher_suite.decrypt(encrypted_data).decode()
+        nonce = token[1:1 + NONCE_SIZE]
+        return self._aead.decrypt(nonce, token[1 + NONCE_SIZE:], None).decode()
+
+    def encrypt_stream(self, data: bytes, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+        """Encrypt a large payload as independently authenticated chunks
+        
+        Args:
+            data: Bytes to encrypt
+            chunk_size: Plaintext bytes per chunk
+            
+        Yields:
+            A header followed by one ciphertext frame per chunk, ready to be
+            written out before the whole payload has been encrypted
+        """
+        prefix = os.urandom(_NONCE_PREFIX_SIZE)
+        yield _STREAM_VERSION + prefix + chunk_size.to_bytes(4, 'big')
+
+        view = memoryview(data)
+        for index, offset in enumerate(range(0, max(len(data), 1), chunk_size)):
+            last = offset + chunk_size >= len(data)
+            nonce = prefix + index.to_bytes(4, 'big')
+            yield self._aead.encrypt(nonce, view[offset:offset + chunk_size], _chunk_aad(last))
+
+    def decrypt_stream(self, encrypted_data: bytes) -> bytes:
+        """Decrypt a payload produced by encrypt_stream
+        
+        Args:
+            encrypted_data: Concatenated header and ciphertext frames
+            
+        Returns:
+            Decrypted bytes
+        """
+        header = encrypted_data[:_STREAM_HEADER_SIZE]
+        body = memoryview(encrypted_data)[_STREAM_HEADER_SIZE:]
+        if header[:1] != _STREAM_VERSION or not body:
+            raise ValueError("Not an encrypted stream")
+
+        prefix = header[1:1 + _NONCE_PREFIX_SIZE]
+        frame_size = int.from_bytes(header[1 + _NONCE_PREFIX_SIZE:], 'big') + _TAG_SIZE
+        chunks = []
+        for index, offset in enumerate(range(0, len(body), frame_size)):
+            last = offset + frame_size >= len(body)
+            nonce = prefix + index.to_bytes(4, 'big')
+            chunks.append(self._aead.decrypt(nonce, body[offset:offset + frame_size], _chunk_aad(last)))
+        return b''.join(chunks)
     
     def secure_store_credentials(self, credentials: Dict[str, Any]) -> bytes:
         """Securely store OAuth credentials
@@ -43,7 +148,7 @@ class SecureEmailHandler:
         Returns:
             Encrypted credentials
         """
-        return self.encrypt_sensitive_data(json.dumps(credentials))
+        return self.encrypt_sensitive_data(orjson.dumps(credentials))
 
 class EmailWorkflowOrchestrator:
     def __init__(self, agents, vector_store):
@@ -68,13 +173,17 @@ class EmailWorkflowOrchestrator:
         """
         with self.telemetry.tracer.start_as_current_span("process_incoming_email") as span:
             try:
-                # Analyze priority
-                priority = await self.analyze_priority(email)
+                if self.vector_store is None:
+                    # No vector store configured yet, so there is no context to retrieve
+                    priority, context = await self.analyze_priority(email), {}
+                else:
+                    # Priority and context don't depend on each other, so fetch them
+                    # concurrently. Start retrieval first so that if it fails, no
+                    # priority coroutine is left un-awaited
+                    retrieval = self.vector_store.retrieve_context(email["content"])
+                    priority, context = await asyncio.gather(self.analyze_priority(email), retrieval)
                 span.set_attribute("email.priority", priority)
                 
-                # Retrieve context
-                context = await self.vector_store.retrieve_context(email["content"])
-                
                 # Generate response based on priority
                 if priority == "urgent":
                     response = await self.generate_immediate_response(email, context)
@@ -149,13 +258,61 @@ class EmailWorkflowOrchestrator:
         with self.telemetry.tracer.start_as_current_span("handle_normal_priority"):
             return await self.agents.response_drafter.generate_response(email, context)
 
+class _LazyJSON:
+    """Defers serializing a value until a log record is actually formatted"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        return orjson.dumps(self.value, default=str).decode()
+
+class _InProcessQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue records unformatted so message formatting runs on the listener thread
+
+    The stock prepare() formats the record in the logging thread to make it
+    picklable, which this in-process queue doesn't need.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+_LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+_log_queue = queue.Queue(-1)
+_telemetry_configured = False
+
+def _configure_telemetry() -> None:
+    """Move log formatting and span export off the request path, once per process"""
+    global _telemetry_configured
+    if _telemetry_configured:
+        return
+    _telemetry_configured = True
+
+    logging.basicConfig(level=logging.INFO, format=_LOG_FORMAT)
+
+    # Records are only enqueued here; a listener thread formats and writes them
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(_LOG_FORMAT))
+    listener = logging.handlers.QueueListener(_log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger(__name__)
+    logger.addHandler(_InProcessQueueHandler(_log_queue))
+    logger.propagate = False
+
+    # Export spans in batches from a background thread when a collector is configured
+    if os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT') or os.getenv('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT'):
+        provider = TracerProvider()
+        provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+        trace.set_tracer_provider(provider)
+
 class EmailAgentTelemetry:
     def __init__(self):
         """Initialize telemetry with logging and tracing"""
-        logging.basicConfig(
-            level=logging.INFO,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
+        _configure_telemetry()
         self.logger = logging.getLogger(__name__)
         self.tracer = trace.get_tracer(__name__)
     
@@ -170,8 +327,9 @@ class EmailAgentTelemetry:
             span.set_attribute("interaction.type", interaction_type)
             span.set_attribute("interaction.timestamp", datetime.now().isoformat())
             
-            self.logger.info(f"Email Interaction: {interaction_type}")
-            self.logger.debug(f"Details: {json.dumps(details)}")
+            self.logger.info("Email Interaction: %s", interaction_type)
+            # Formatted lazily, and only if DEBUG is enabled
+            self.logger.debug("Details: %s", _LazyJSON(details))
     
     def log_error(self, message: str, error: str) -> None:
         """Log error with tracing
@@ -185,4 +343,4 @@ class EmailAgentTelemetry:
             span.set_attribute("error.details", error)
             span.set_status(Status(StatusCode.ERROR), error)
             
-            self.logger.error(f"{message}: {error}")
+            self.logger.error("%s: %s", message, error)